@@ -9,15 +9,15 @@ import sys
 import time
 import json
 import hashlib
+import io
 import logging
 import base64
+import struct
+import uuid
+import threading
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Dict, Optional
-
-import requests
-from PIL import Image
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from typing import List, Dict, Optional, Tuple
 
 
 # ==================== 配置区域 ====================
@@ -38,6 +38,9 @@ class Config:
     # 从您的日志看，正确的端点是 /v1
     DIFY_API_PREFIX = "/v1"
 
+    # 校验模式: fast 只解析文件头(格式+尺寸)，full 额外用PIL做完整verify
+    VALIDATION_MODE = "fast"
+
     # 处理设置
     MAX_RETRY = 3
     RETRY_DELAY = 5
@@ -45,17 +48,32 @@ class Config:
 
 
 # ==================== 日志配置 ====================
+_trace_context = threading.local()
+
+
+class TraceIdFilter(logging.Filter):
+    """把当前线程的图片追踪ID注入日志记录"""
+
+    def filter(self, record):
+        record.trace_id = getattr(_trace_context, 'trace_id', None) or '-'
+        return True
+
+
 def setup_logging():
     os.makedirs("logs", exist_ok=True)
     log_file = "logs/image_monitor.log"
 
+    handlers = [
+        logging.FileHandler(log_file, encoding='utf-8'),
+        logging.StreamHandler(sys.stdout)
+    ]
+    for handler in handlers:
+        handler.addFilter(TraceIdFilter())
+
     logging.basicConfig(
         level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(log_file, encoding='utf-8'),
-            logging.StreamHandler(sys.stdout)
-        ]
+        format='%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s',
+        handlers=handlers
     )
     return logging.getLogger(__name__)
 
@@ -63,6 +81,132 @@ def setup_logging():
 logger = setup_logging()
 
 
+# ==================== 性能追踪 ====================
+class Tracer:
+    """按阶段记录耗时，可导出为Chrome trace-event JSON（chrome://tracing / Perfetto）
+
+    每张图片处理完后把事件追加写入文件，内存中只保留尚未写出的部分
+    """
+
+    FLUSH_THRESHOLD = 1000
+
+    def __init__(self):
+        self.enabled = False
+        self.events: List[Dict] = []
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._file = None
+        self._written = 0
+
+    def start(self, trace_file: str):
+        """打开追踪文件并开始记录；异常退出时文件缺少结尾的]，Chrome/Perfetto仍可加载"""
+        try:
+            self._file = open(trace_file, 'w', encoding='utf-8')
+            self._file.write('[')
+            self._file.flush()
+            self.enabled = True
+        except Exception as e:
+            logger.error(f"打开追踪文件失败: {e}")
+
+    def now_us(self) -> float:
+        return (time.perf_counter() - self._origin) * 1e6
+
+    @contextmanager
+    def trace(self, image_path: str):
+        """为一张图片分配追踪ID，期间的日志和span都带上该ID"""
+        previous = getattr(_trace_context, 'trace_id', None)
+        _trace_context.trace_id = uuid.uuid4().hex[:8]
+        try:
+            with self.span("process_image", file=os.path.basename(image_path)):
+                yield _trace_context.trace_id
+        finally:
+            _trace_context.trace_id = previous
+            self.flush()
+
+    @contextmanager
+    def span(self, name: str, **args):
+        start = self.now_us()
+        try:
+            yield
+        finally:
+            duration = self.now_us() - start
+            if self.enabled:
+                logger.info(f"⏱️ {name} 耗时 {duration / 1e6:.3f}s")
+            self.record(name, start, duration, **args)
+
+    def record(self, name: str, start_us: float, duration_us: float, **args):
+        """记录一个已完成的span（用于外部服务上报的耗时）"""
+        if not self.enabled:
+            return
+        args['trace_id'] = getattr(_trace_context, 'trace_id', None) or '-'
+        event = {
+            "name": name,
+            "cat": "image",
+            "ph": "X",
+            "ts": round(start_us, 3),
+            "dur": round(max(duration_us, 0.0), 3),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args
+        }
+        with self._lock:
+            self.events.append(event)
+            pending = len(self.events)
+        if pending >= self.FLUSH_THRESHOLD:
+            self.flush()
+
+    def flush(self):
+        """把缓冲中的事件追加写入追踪文件"""
+        with self._lock:
+            if not self._file or not self.events:
+                return
+            events, self.events = self.events, []
+            try:
+                for event in events:
+                    self._file.write(',\n' if self._written else '\n')
+                    self._file.write(json.dumps(event, ensure_ascii=False))
+                    self._written += 1
+                self._file.flush()
+            except Exception as e:
+                logger.error(f"写入追踪文件失败: {e}")
+
+    def close(self):
+        if not self._file:
+            return
+        self.flush()
+        with self._lock:
+            try:
+                self._file.write('\n]\n')
+                self._file.close()
+                print(f"📈 性能追踪已写入: {self._file.name} ({self._written} 个事件)")
+            except Exception as e:
+                logger.error(f"写入追踪文件失败: {e}")
+            self._file = None
+            self.enabled = False
+
+
+tracer = Tracer()
+
+
+@contextmanager
+def cprofile_to(profile_file: Optional[str]):
+    """在代码块内运行cProfile，并把结果dump到profile_file（为空则不启用）"""
+    if not profile_file:
+        yield
+        return
+
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_file)
+        print(f"📈 cProfile结果已写入: {profile_file}")
+
+
 # ==================== 状态管理器 ====================
 class StateManager:
     def __init__(self, state_file: str = "processed_files.json"):
@@ -81,8 +225,9 @@ class StateManager:
 
     def save_state(self):
         try:
-            with open(self.state_file, 'w', encoding='utf-8') as f:
-                json.dump(self.processed_files, f, indent=2, ensure_ascii=False)
+            with tracer.span("save_state", entries=len(self.processed_files)):
+                with open(self.state_file, 'w', encoding='utf-8') as f:
+                    json.dump(self.processed_files, f, indent=2, ensure_ascii=False)
         except Exception as e:
             logger.error(f"保存状态文件失败: {e}")
 
@@ -109,28 +254,143 @@ class StateManager:
             return hashlib.md5(file_path.encode()).hexdigest()
 
 
+# ==================== 图片头校验 ====================
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def _sniff_jpeg(data: bytes) -> Tuple[int, int]:
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            raise ValueError("JPEG段标记错误")
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            pos += 2
+            continue
+        if marker in (0xD9, 0xDA):
+            break
+        length = struct.unpack('>H', data[pos + 2:pos + 4])[0]
+        if marker in _JPEG_SOF_MARKERS:
+            if pos + 9 > len(data):
+                break
+            height, width = struct.unpack('>HH', data[pos + 5:pos + 9])
+            return width, height
+        pos += 2 + length
+    raise ValueError("未找到JPEG尺寸信息")
+
+
+def _sniff_webp(data: bytes) -> Tuple[int, int]:
+    chunk = data[12:16]
+    if chunk == b'VP8 ' and len(data) >= 30 and data[23:26] == b'\x9d\x01\x2a':
+        width, height = struct.unpack('<HH', data[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L' and len(data) >= 25 and data[20] == 0x2F:
+        bits = struct.unpack('<I', data[21:25])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8X' and len(data) >= 30:
+        width = int.from_bytes(data[24:27], 'little') + 1
+        height = int.from_bytes(data[27:30], 'little') + 1
+        return width, height
+    raise ValueError("无法识别的WEBP数据块")
+
+
+def sniff_image_header(data: bytes) -> Tuple[str, int, int]:
+    """只根据文件头识别图片格式和尺寸，不做完整解码
+
+    返回 (格式, 宽, 高)，无法识别或尺寸非法时抛出 ValueError
+    """
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and data[12:16] == b'IHDR' and len(data) >= 24:
+        fmt = 'png'
+        width, height = struct.unpack('>II', data[16:24])
+    elif data[:3] == b'\xff\xd8\xff':
+        fmt = 'jpeg'
+        width, height = _sniff_jpeg(data)
+    elif data[:6] in (b'GIF87a', b'GIF89a') and len(data) >= 10:
+        fmt = 'gif'
+        width, height = struct.unpack('<HH', data[6:10])
+    elif data[:2] == b'BM' and len(data) >= 26:
+        fmt = 'bmp'
+        dib_size = struct.unpack('<I', data[14:18])[0]
+        if dib_size == 12:
+            width, height = struct.unpack('<HH', data[18:22])
+        else:
+            width, height = struct.unpack('<ii', data[18:26])
+            height = abs(height)
+    elif data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        fmt = 'webp'
+        width, height = _sniff_webp(data)
+    else:
+        raise ValueError("不支持的图片格式或文件头损坏")
+
+    if width <= 0 or height <= 0:
+        raise ValueError(f"图片尺寸非法: {width}x{height}")
+    return fmt, width, height
+
+
+def check_image_trailer(fmt: str, data: bytes):
+    """检查文件是否包含结束标记，用于发现复制到一半的图片；不完整时抛出 ValueError
+
+    结束标记之后允许有附加数据（如动态照片末尾的MP4、补零）
+    """
+    if fmt == 'png':
+        complete = data.rfind(b'IEND\xaeB`\x82', 8) != -1
+    elif fmt == 'jpeg':
+        complete = data.rfind(b'\xff\xd9', 2) != -1
+    elif fmt == 'gif':
+        complete = data.rfind(b'\x00\x3b', 13) != -1
+    elif fmt == 'webp':
+        complete = struct.unpack('<I', data[4:8])[0] + 8 <= len(data)
+    elif fmt == 'bmp':
+        complete = struct.unpack('<I', data[2:6])[0] <= len(data)
+    else:
+        complete = True
+
+    if not complete:
+        raise ValueError(f"{fmt}文件不完整（可能仍在写入）")
+
+
 # ==================== 图片处理器 ====================
 class ImageProcessor:
     def __init__(self):
         self.state_manager = StateManager()
 
+    def validate_image(self, image_data: bytes):
+        """校验已读入内存的图片数据，失败时抛出异常"""
+        fmt, width, height = sniff_image_header(image_data)
+        check_image_trailer(fmt, image_data)
+        logger.info(f"图片格式: {fmt} {width}x{height}")
+
+        if Config.VALIDATION_MODE == "full":
+            from PIL import Image
+
+            with Image.open(io.BytesIO(image_data)) as img:
+                img.verify()
+
     def extract_image_info(self, image_path: str) -> Optional[str]:
+        import requests
+
         if not os.path.exists(image_path):
             return None
 
         try:
-            with Image.open(image_path) as img:
-                img.verify()
+            with tracer.span("read_file"):
+                with open(image_path, 'rb') as f:
+                    image_data = f.read()
+
+            with tracer.span("validate", mode=Config.VALIDATION_MODE):
+                self.validate_image(image_data)
         except Exception as e:
             logger.error(f"图片文件损坏 {image_path}: {e}")
             return None
 
+        with tracer.span("base64_encode", bytes=len(image_data)):
+            image_base64 = base64.b64encode(image_data).decode('utf-8')
+
         for attempt in range(Config.MAX_RETRY):
             try:
-                with open(image_path, 'rb') as f:
-                    image_data = f.read()
-
-                image_base64 = base64.b64encode(image_data).decode('utf-8')
                 url = f"{Config.OLLAMA_HOST}/api/generate"
 
                 prompt = """请用中文详细描述这张图片：
@@ -153,10 +413,12 @@ class ImageProcessor:
                 }
 
                 logger.info(f"正在分析图片: {os.path.basename(image_path)}")
-                response = requests.post(url, json=payload, timeout=Config.REQUEST_TIMEOUT)
-                response.raise_for_status()
-
-                result = response.json()
+                with tracer.span("ollama_request", attempt=attempt + 1, model=Config.OLLAMA_MODEL):
+                    request_start = tracer.now_us()
+                    response = requests.post(url, json=payload, timeout=Config.REQUEST_TIMEOUT)
+                    response.raise_for_status()
+                    result = response.json()
+                    self._record_ollama_timings(result, request_start, tracer.now_us() - request_start)
                 description = result.get('response', '').strip()
 
                 if description and len(description) > 30:
@@ -169,8 +431,36 @@ class ImageProcessor:
 
         return None
 
+    def _record_ollama_timings(self, result: Dict, start_us: float, wall_us: float):
+        """按Ollama返回的耗时字段(纳秒)拆分请求：网络/HTTP开销、调度排队+模型加载、提示词处理、生成"""
+        # Ollama不单独上报排队时间：等待空闲runner的时间计入load_duration
+        schedule_load_us = result.get('load_duration', 0) / 1e3
+        prompt_us = result.get('prompt_eval_duration', 0) / 1e3
+        eval_us = result.get('eval_duration', 0) / 1e3
+        total_us = result.get('total_duration', 0) / 1e3
+        if not total_us:
+            return
+
+        overhead_us = max(wall_us - total_us, 0.0)
+        if tracer.enabled:
+            logger.info(f"⏱️ Ollama拆分: 网络/HTTP {overhead_us / 1e6:.3f}s, "
+                        f"排队+加载 {schedule_load_us / 1e6:.3f}s, "
+                        f"提示词 {prompt_us / 1e6:.3f}s, 生成 {eval_us / 1e6:.3f}s "
+                        f"({result.get('eval_count', 0)} tokens)")
+
+        cursor = start_us
+        for name, duration_us, args in (
+                ("ollama_overhead", overhead_us, {}),
+                ("ollama_schedule_load", schedule_load_us, {}),
+                ("ollama_prompt_eval", prompt_us, {"tokens": result.get('prompt_eval_count', 0)}),
+                ("ollama_generate", eval_us, {"tokens": result.get('eval_count', 0)})):
+            tracer.record(name, cursor, duration_us, **args)
+            cursor += duration_us
+
     def upload_to_knowledge_base(self, image_path: str, description: str) -> bool:
         """上传到Dify知识库 - 修正的API端点"""
+        import requests
+
         if not description:
             return False
 
@@ -203,7 +493,8 @@ description: {description}
                 logger.info(f"📤 正在上传: {file_name}")
                 logger.info(f"🌐 API地址: {url}")
 
-                response = requests.post(url, json=data, headers=headers, timeout=30)
+                with tracer.span("dify_upload", attempt=attempt + 1):
+                    response = requests.post(url, json=data, headers=headers, timeout=30)
                 logger.info(f"📊 响应状态: {response.status_code}")
 
                 if response.status_code in [200, 201, 202]:
@@ -223,6 +514,10 @@ description: {description}
         return False
 
     def process_image(self, image_path: str) -> bool:
+        with tracer.trace(image_path):
+            return self._process_image(image_path)
+
+    def _process_image(self, image_path: str) -> bool:
         if not os.path.exists(image_path):
             return False
 
@@ -237,7 +532,8 @@ description: {description}
         print(f"\n🔍 处理图片: {os.path.basename(image_path)}")
 
         # 生成描述
-        description = self.extract_image_info(image_path)
+        with tracer.span("describe"):
+            description = self.extract_image_info(image_path)
         if not description:
             print("❌ 描述生成失败")
             return False
@@ -245,7 +541,10 @@ description: {description}
         print(f"✅ 描述生成完成")
 
         # 上传
-        if self.upload_to_knowledge_base(image_path, description):
+        with tracer.span("upload"):
+            uploaded = self.upload_to_knowledge_base(image_path, description)
+
+        if uploaded:
             self.state_manager.mark_processed(image_path, description)
             print(f"🎉 处理完成！")
             return True
@@ -255,7 +554,9 @@ description: {description}
 
 
 # ==================== 文件监控器 ====================
-class ImageFileHandler(FileSystemEventHandler):
+class ImageFileHandler:
+    """图片事件处理逻辑；在main()中与watchdog的FileSystemEventHandler组合，避免导入时加载watchdog"""
+
     def __init__(self, processor: ImageProcessor):
         self.processor = processor
 
@@ -285,7 +586,9 @@ class ImageFileHandler(FileSystemEventHandler):
 
 
 # ==================== 主程序 ====================
-def main():
+def main(cprofile_file: Optional[str] = None):
+    import requests
+
     print(f"""
     {'=' * 60}
     📸 本地图片监控服务
@@ -318,7 +621,13 @@ def main():
     processor = ImageProcessor()
 
     # 文件监控
-    event_handler = ImageFileHandler(processor)
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+
+    class WatchdogImageFileHandler(ImageFileHandler, FileSystemEventHandler):
+        pass
+
+    event_handler = WatchdogImageFileHandler(processor)
     observer = Observer()
     observer.schedule(event_handler, Config.MONITOR_DIR, recursive=True)
 
@@ -330,16 +639,17 @@ def main():
         processed_count = 0
         failed_count = 0
 
-        for root, dirs, files in os.walk(Config.MONITOR_DIR):
-            for file in files:
-                ext = os.path.splitext(file)[1].lower()
-                if ext in Config.SUPPORTED_FORMATS:
-                    file_path = os.path.join(root, file)
-                    if not processor.state_manager.is_processed(file_path):
-                        if processor.process_image(file_path):
-                            processed_count += 1
-                        else:
-                            failed_count += 1
+        with cprofile_to(cprofile_file):
+            for root, dirs, files in os.walk(Config.MONITOR_DIR):
+                for file in files:
+                    ext = os.path.splitext(file)[1].lower()
+                    if ext in Config.SUPPORTED_FORMATS:
+                        file_path = os.path.join(root, file)
+                        if not processor.state_manager.is_processed(file_path):
+                            if processor.process_image(file_path):
+                                processed_count += 1
+                            else:
+                                failed_count += 1
 
         print(f"\n📊 扫描完成: ✅{processed_count} ❌{failed_count}")
         print(f"\n🎯 进入监控模式...")
@@ -366,44 +676,72 @@ if __name__ == "__main__":
     parser.add_argument("--dir", help=f"监控目录")
     parser.add_argument("--scan", action="store_true", help="只扫描")
     parser.add_argument("--test-api", action="store_true", help="测试API连接")
+    parser.add_argument("--status", action="store_true", help="查看已处理文件统计")
+    parser.add_argument("--validate", choices=["fast", "full"], help="图片校验模式：fast只解析文件头，full完整verify")
+    parser.add_argument("--profile", metavar="TRACE_JSON", help="记录各阶段耗时并写入Chrome trace-event JSON")
+    parser.add_argument("--cprofile", metavar="PSTATS",
+                        help="对扫描阶段运行cProfile并写入pstats文件（仅用于--scan或监控启动时的扫描）")
 
     args = parser.parse_args()
 
+    if args.cprofile and (args.test_api or args.status):
+        parser.error("--cprofile 只能用于扫描阶段，不能与 --test-api/--status 同时使用")
+
     if args.dir:
         Config.MONITOR_DIR = args.dir
+    if args.validate:
+        Config.VALIDATION_MODE = args.validate
 
-    if args.test_api:
-        # 测试API连接
-        print("=== 测试Dify API连接 ===")
+    if args.profile:
+        tracer.start(args.profile)
 
-        # 测试正确的端点
-        test_url = f"{Config.DIFY_BASE_URL}{Config.DIFY_API_PREFIX}/datasets"
-        headers = {"Authorization": f"Bearer {Config.DIFY_API_KEY}"}
-
-        print(f"测试端点: {test_url}")
-        try:
-            response = requests.get(test_url, headers=headers, timeout=5)
-            print(f"状态码: {response.status_code}")
-            print(f"响应: {response.text[:200]}")
-        except Exception as e:
-            print(f"连接失败: {e}")
+    try:
+        if args.test_api:
+            import requests
 
-    elif args.scan:
-        # 只扫描模式
-        processor = ImageProcessor()
-        processed_count = 0
-        failed_count = 0
+            # 测试API连接
+            print("=== 测试Dify API连接 ===")
 
-        for root, dirs, files in os.walk(Config.MONITOR_DIR):
-            for file in files:
-                ext = os.path.splitext(file)[1].lower()
-                if ext in Config.SUPPORTED_FORMATS:
-                    file_path = os.path.join(root, file)
-                    if processor.process_image(file_path):
-                        processed_count += 1
-                    else:
-                        failed_count += 1
+            # 测试正确的端点
+            test_url = f"{Config.DIFY_BASE_URL}{Config.DIFY_API_PREFIX}/datasets"
+            headers = {"Authorization": f"Bearer {Config.DIFY_API_KEY}"}
 
-        print(f"\n📊 扫描完成: ✅{processed_count} ❌{failed_count}")
-    else:
-        main()
\ No newline at end of file
+            print(f"测试端点: {test_url}")
+            try:
+                response = requests.get(test_url, headers=headers, timeout=5)
+                print(f"状态码: {response.status_code}")
+                print(f"响应: {response.text[:200]}")
+            except Exception as e:
+                print(f"连接失败: {e}")
+
+        elif args.status:
+            state_manager = StateManager()
+            records = state_manager.processed_files
+            print(f"📄 状态文件: {os.path.abspath(state_manager.state_file)}")
+            print(f"📊 已处理: {len(records)} 个文件")
+            if records:
+                latest = max(records.values(), key=lambda r: r.get('processed_time', ''))
+                print(f"🕒 最近处理: {latest.get('processed_time', '')} {latest.get('path', '')}")
+
+        elif args.scan:
+            # 只扫描模式
+            processor = ImageProcessor()
+            processed_count = 0
+            failed_count = 0
+
+            with cprofile_to(args.cprofile):
+                for root, dirs, files in os.walk(Config.MONITOR_DIR):
+                    for file in files:
+                        ext = os.path.splitext(file)[1].lower()
+                        if ext in Config.SUPPORTED_FORMATS:
+                            file_path = os.path.join(root, file)
+                            if processor.process_image(file_path):
+                                processed_count += 1
+                            else:
+                                failed_count += 1
+
+            print(f"\n📊 扫描完成: ✅{processed_count} ❌{failed_count}")
+        else:
+            main(cprofile_file=args.cprofile)
+    finally:
+        tracer.close()
\ No newline at end of file